@@ -4,23 +4,140 @@ Analyzes transaction data using OpenRouter API to provide emotional and financia
 """
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-from collections import defaultdict
+from fastapi.responses import JSONResponse, ORJSONResponse
+import asyncio
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+import hashlib
+import os
 import time
-from typing import Dict
+import orjson
+from typing import Dict, Optional
+import httpx
 from dotenv import load_dotenv
 
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    # Redis is optional; rate limiting falls back to the in-memory store
+    aioredis = None
+
 from app.schemas import AnalyzeRequest, AnalysisResponse
-from app.openrouter_client import OpenRouterClient
+from app.openrouter_client import OpenRouterClient, build_client
+from app.transport import build_aiohttp_transport
 
 # Load environment variables
 load_dotenv()
 
+# OpenRouter client, created once at startup (see lifespan below)
+openrouter_client: Optional[OpenRouterClient] = None
+
+# Redis client for distributed rate limiting, created at startup if REDIS_URL
+# is configured; None means the in-memory fallback is in use
+redis_client = None
+_rate_limit_sha: Optional[str] = None
+
+# Atomic sliding-window check: trim expired entries, reject if the window is
+# full, otherwise record the request. One round trip per check, and correct
+# across multiple uvicorn workers. KEYS[1] = "rl:<user_id>",
+# ARGV = [now, window_seconds, max_requests]. Returns 1 if allowed, or the
+# negated number of seconds until the window can reset if blocked.
+_RATE_LIMIT_LUA = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], 0, ARGV[1] - ARGV[2])
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[3]) then
+    local oldest = tonumber(redis.call('ZRANGE', KEYS[1], 0, 0)[1])
+    return -math.ceil(oldest + ARGV[2] - ARGV[1])
+end
+redis.call('ZADD', KEYS[1], ARGV[1], ARGV[1])
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+
+# Cache of completed analyses keyed by a content hash of the request (user_id
+# excluded, so identical transaction lists share an entry). A hit returns in
+# milliseconds instead of a multi-second LLM round trip, and saves the spend.
+# LRU-bounded with a TTL so entries go stale before spending patterns do.
+_analysis_cache: "OrderedDict[str, tuple]" = OrderedDict()
+ANALYSIS_CACHE_TTL = 3600  # seconds
+ANALYSIS_CACHE_MAX_ENTRIES = 1000
+
+# Single-flight map: identical requests that arrive while an LLM call is
+# already in progress await that call's task instead of fanning out N calls
+_in_flight: Dict[str, asyncio.Task] = {}
+
+# Local cache of users known to be over the limit, mapping user_id to the time
+# their window can reset. Lets repeat offenders be rejected without touching
+# the store at all. LRU-bounded so an attacker can't grow it without limit.
+_blocked_until: "OrderedDict[str, float]" = OrderedDict()
+_BLOCKED_CACHE_MAX = 10_000
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Create a single long-lived HTTP client at startup and close it on shutdown.
+    Reusing one client across all /analyze calls keeps connections to the LLM
+    provider alive (pooling + keep-alive) instead of paying a fresh TCP+TLS
+    handshake per request.
+    """
+    global openrouter_client, redis_client, _rate_limit_sha
+
+    # Granular timeouts: fail fast on connect/pool acquisition, but leave the
+    # full 30s for the LLM to stream its answer back
+    timeout = httpx.Timeout(connect=5.0, read=30.0, write=10.0, pool=5.0)
+
+    # Prefer an aiohttp-backed transport for better behavior under concurrent
+    # load; fall back to httpx's default transport if aiohttp is unavailable.
+    # HTTP/2 on the fallback multiplexes concurrent analyses over one TLS
+    # session to Google instead of a handshake per burst request.
+    transport = build_aiohttp_transport()
+    if transport is not None:
+        app.state.http_client = httpx.AsyncClient(
+            transport=transport,
+            timeout=timeout,
+        )
+    else:
+        app.state.http_client = httpx.AsyncClient(
+            timeout=timeout,
+            limits=httpx.Limits(
+                max_connections=200,
+                max_keepalive_connections=100,
+                keepalive_expiry=75.0,
+            ),
+            http2=True,
+        )
+
+    try:
+        openrouter_client = build_client(app.state.http_client)
+    except ValueError as e:
+        print(f"WARNING: {e}")
+        openrouter_client = None
+
+    # Connect Redis and preload the rate-limit script so each check is a
+    # single EVALSHA round trip
+    redis_url = os.getenv("REDIS_URL")
+    if redis_url and aioredis is not None:
+        try:
+            redis_client = aioredis.from_url(redis_url)
+            _rate_limit_sha = await redis_client.script_load(_RATE_LIMIT_LUA)
+        except Exception as e:
+            print(f"WARNING: Redis unavailable, using in-memory rate limiting: {e}")
+            redis_client = None
+
+    yield
+
+    await app.state.http_client.aclose()
+    if redis_client is not None:
+        await redis_client.close()
+
+
 # Initialize FastAPI app
 app = FastAPI(
     title="FinoSpark MVP",
     description="Emotional and financial insights from transaction data",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
 # CORS middleware to allow frontend requests
@@ -32,34 +149,124 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Initialize OpenRouter client
-try:
-    openrouter_client = OpenRouterClient()
-except ValueError as e:
-    print(f"WARNING: {e}")
-    openrouter_client = None
-
-# Simple in-memory rate limiting (placeholder for production rate limiter)
-# In production, use Redis or similar for distributed rate limiting
-rate_limit_store: Dict[str, list] = defaultdict(list)
+# Simple in-memory rate limiting, used when Redis isn't configured. The store
+# is LRU-bounded: without a cap it would keep an entry for every user_id ever
+# seen, so spamming random ids could grow it without limit. Evicted users are
+# the least recently active, whose windows have long expired anyway.
+rate_limit_store: "OrderedDict[str, deque]" = OrderedDict()
+RATE_LIMIT_STORE_MAX = 100_000
 RATE_LIMIT_WINDOW = 60  # seconds
 RATE_LIMIT_MAX_REQUESTS = 10  # max requests per window
 
 
-def check_rate_limit(user_id: str) -> bool:
+async def check_rate_limit(user_id: str) -> bool:
     """
-    Simple in-memory rate limiting
+    Sliding-window rate limiting
+    Uses Redis when configured (so the limit holds across multiple workers),
+    falling back to the in-memory store otherwise
     Returns True if request is allowed, False if rate limit exceeded
     """
     now = time.time()
-    user_requests = rate_limit_store[user_id]
-    
-    # Remove old requests outside the window
-    user_requests[:] = [req_time for req_time in user_requests if now - req_time < RATE_LIMIT_WINDOW]
-    
+
+    # Short-circuit clients we already know are blocked: no store round trip
+    # until their window has had a chance to reset
+    expiry = _blocked_until.get(user_id)
+    if expiry is not None:
+        if expiry > now:
+            return False
+        del _blocked_until[user_id]
+
+    if redis_client is not None:
+        try:
+            result = await redis_client.evalsha(
+                _rate_limit_sha, 1, f"rl:{user_id}",
+                now, RATE_LIMIT_WINDOW, RATE_LIMIT_MAX_REQUESTS
+            )
+            if result == 1:
+                return True
+            # result is -(seconds until reset); remember it locally
+            _mark_blocked(user_id, now - result)
+            return False
+        except Exception:
+            # Redis hiccup: degrade to the local window rather than erroring
+            pass
+
+    return _check_rate_limit_local(user_id, now)
+
+
+def _mark_blocked(user_id: str, until: float) -> None:
+    """Record a blocked user in the LRU-bounded local cache"""
+    _blocked_until[user_id] = until
+    _blocked_until.move_to_end(user_id)
+    while len(_blocked_until) > _BLOCKED_CACHE_MAX:
+        _blocked_until.popitem(last=False)
+
+
+def _request_cache_key(request: AnalyzeRequest) -> str:
+    """Stable content hash of an analyze request, ignoring user identity"""
+    payload = orjson.dumps(
+        request.model_dump(exclude={'user_id'}),
+        option=orjson.OPT_SORT_KEYS
+    )
+    return hashlib.blake2b(payload).hexdigest()
+
+
+def _cache_get(key: str):
+    """Return a cached analysis if present and fresh, else None"""
+    entry = _analysis_cache.get(key)
+    if entry is None:
+        return None
+    expires_at, result = entry
+    if expires_at < time.time():
+        del _analysis_cache[key]
+        return None
+    _analysis_cache.move_to_end(key)
+    return result
+
+
+def _cache_put(key: str, result) -> None:
+    """Store an analysis result, evicting the least recently used entries"""
+    _analysis_cache[key] = (time.time() + ANALYSIS_CACHE_TTL, result)
+    _analysis_cache.move_to_end(key)
+    while len(_analysis_cache) > ANALYSIS_CACHE_MAX_ENTRIES:
+        _analysis_cache.popitem(last=False)
+
+
+def _finish_in_flight(key: str):
+    """
+    Done callback for a single-flight task: drop it from the map and retrieve
+    its exception so asyncio doesn't log it as never retrieved when every
+    waiter has already disconnected
+    """
+    def _done(task: asyncio.Task) -> None:
+        _in_flight.pop(key, None)
+        if not task.cancelled():
+            task.exception()
+    return _done
+
+
+def _check_rate_limit_local(user_id: str, now: float) -> bool:
+    """In-memory sliding-window check (single-process only)"""
+    user_requests = rate_limit_store.get(user_id)
+    if user_requests is None:
+        # Bounded deque: can never hold more than one entry over the limit
+        user_requests = deque(maxlen=RATE_LIMIT_MAX_REQUESTS + 1)
+        rate_limit_store[user_id] = user_requests
+        while len(rate_limit_store) > RATE_LIMIT_STORE_MAX:
+            rate_limit_store.popitem(last=False)
+    else:
+        rate_limit_store.move_to_end(user_id)
+
+    # Timestamps are appended in order, so expired entries are always at the
+    # front; pop them lazily instead of rebuilding the whole list
+    cutoff = now - RATE_LIMIT_WINDOW
+    while user_requests and user_requests[0] < cutoff:
+        user_requests.popleft()
+
     if len(user_requests) >= RATE_LIMIT_MAX_REQUESTS:
+        _mark_blocked(user_id, user_requests[0] + RATE_LIMIT_WINDOW)
         return False
-    
+
     user_requests.append(now)
     return True
 
@@ -75,13 +282,14 @@ async def root():
 
 
 @app.post("/analyze", response_model=AnalysisResponse)
-async def analyze_transactions(request: AnalyzeRequest):
+async def analyze_transactions(request: AnalyzeRequest, bypass_cache: bool = False):
     """
     Analyze transaction data and return emotional + financial insights
-    
+
     Args:
         request: AnalyzeRequest containing user_id, transactions, and optional notes
-    
+        bypass_cache: Set ?bypass_cache=1 to force a fresh LLM analysis
+
     Returns:
         AnalysisResponse with emotional tone, financial profile, insights, recommendations, and savings plan
     
@@ -106,31 +314,43 @@ async def analyze_transactions(request: AnalyzeRequest):
         )
     
     # Check rate limit
-    if not check_rate_limit(request.user_id):
+    if not await check_rate_limit(request.user_id):
         raise HTTPException(
             status_code=429,
             detail=f"Rate limit exceeded. Maximum {RATE_LIMIT_MAX_REQUESTS} requests per {RATE_LIMIT_WINDOW} seconds."
         )
     
-    # Validate that we have transactions
-    if not request.transactions or len(request.transactions) == 0:
-        raise HTTPException(
-            status_code=400,
-            detail="At least one transaction is required for analysis"
-        )
-    
-    # Call OpenRouter API for analysis
-    result = await openrouter_client.analyze_transactions(request)
-    
-    # Check if result is an error
-    if "error" in result:
+    # Identical transaction lists share one cached analysis
+    cache_key = _request_cache_key(request)
+    if not bypass_cache:
+        cached = _cache_get(cache_key)
+        if cached is not None:
+            return cached
+
+    # Collapse concurrent identical requests onto one upstream LLM call. The
+    # call runs as its own task and each waiter awaits a shield of it, so one
+    # client disconnecting cancels neither the shared call nor the other
+    # waiters; the done callback cleans the map up whatever the outcome.
+    task = _in_flight.get(cache_key)
+    if task is None:
+        # Call OpenRouter API for analysis
+        task = asyncio.create_task(openrouter_client.analyze_transactions(request))
+        _in_flight[cache_key] = task
+        task.add_done_callback(_finish_in_flight(cache_key))
+    result = await asyncio.shield(task)
+
+    # Check if result is an error (success returns an AnalysisResponse model)
+    if isinstance(result, dict):
         # Return error response with 200 status but error structure
         # This allows frontend to handle gracefully
         return JSONResponse(
             status_code=200,
             content=result
         )
-    
+
+    # Only successful analyses are cached (a bypass still refreshes the entry)
+    _cache_put(cache_key, result)
+
     return result
 
 
@@ -146,4 +366,16 @@ async def health_check():
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # uvloop and httptools ship with uvicorn[standard]; per-request access
+    # logging is a synchronous call on the hot path, so it stays off here.
+    # Workers require the app as an import string, and the Redis-backed rate
+    # limiter keeps the limit correct across them.
+    uvicorn.run(
+        "app.main:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="uvloop",
+        http="httptools",
+        access_log=False,
+        workers=int(os.getenv("WEB_CONCURRENCY", "4")),
+    )
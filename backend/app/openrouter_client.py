@@ -2,35 +2,150 @@
 OpenRouter API client for LLM analysis
 """
 import os
-import json
+import orjson
 import re
 import httpx
-from typing import Dict, Any, Optional
+from pydantic import TypeAdapter
+from typing import Dict, Any, Optional, Union
 from app.schemas import AnalyzeRequest, AnalysisResponse, ErrorResponse
 
+# Cached core schema for AnalysisResponse; validate_json parses and validates
+# raw LLM output in one pass, skipping the intermediate dict
+_ANALYSIS_ADAPTER = TypeAdapter(AnalysisResponse)
+
+
+def _inline_refs(schema: Any, defs: Dict[str, Any]) -> Any:
+    """Recursively inline $ref entries and drop keys Gemini's schema subset rejects"""
+    if isinstance(schema, dict):
+        if '$ref' in schema:
+            name = schema['$ref'].split('/')[-1]
+            return _inline_refs(defs[name], defs)
+        return {
+            k: _inline_refs(v, defs)
+            for k, v in schema.items()
+            if k not in ('$defs', 'title', 'default')
+        }
+    if isinstance(schema, list):
+        return [_inline_refs(item, defs) for item in schema]
+    return schema
+
+
+def _build_analysis_schema() -> Dict[str, Any]:
+    """Gemini-compatible responseSchema derived from AnalysisResponse"""
+    schema = AnalysisResponse.model_json_schema()
+    return _inline_refs(schema, schema.get('$defs', {}))
+
+
+# Passed to Gemini's structured-output mode so the model is constrained to
+# return raw JSON matching our response model
+_ANALYSIS_JSON_SCHEMA = _build_analysis_schema()
+
+# Precompiled patterns for JSON extraction (compiling per call is wasted work
+# on the hot path, and re's internal cache can evict under load)
+_MD_FENCE_START = re.compile(r'^```[a-zA-Z]*\s*')
+_MD_FENCE_END = re.compile(r'```$')
+_TRAILING_COMMA = re.compile(r',\s*([}\]])')
+
+
+def _find_balanced_json(text: str) -> Optional[str]:
+    """
+    Find the first balanced JSON object in text with a single linear scan.
+    Tracks brace depth and string/escape state so braces inside string values
+    don't confuse the match. If the object is truncated, the unterminated
+    string (if any) and the missing closing braces are appended.
+    Returns None if no '{' is found.
+    """
+    start = text.find('{')
+    if start == -1:
+        return None
+
+    depth = 0
+    in_string = False
+    escape = False
+    for i in range(start, len(text)):
+        ch = text[i]
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == '\\':
+                escape = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch == '{':
+            depth += 1
+        elif ch == '}':
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1]
+
+    # Truncated output: close any open string, then the open braces
+    candidate = text[start:]
+    if in_string:
+        candidate += '"'
+    return candidate + '}' * depth
+
+
+class _JsonStreamTracker:
+    """
+    Incrementally tracks brace depth and string/escape state across streamed
+    text chunks, so a caller can stop reading as soon as a complete JSON
+    object has arrived
+    """
 
-class OpenRouterClient:
-    """Client for interacting with OpenRouter API or Google Gemini API"""
-    
     def __init__(self):
-        # Try Google Gemini API first (more reliable)
-        self.google_api_key = os.getenv("GOOGLE_API_KEY")
-        self.openrouter_api_key = os.getenv("OPENROUTER_API_KEY")
-        
-        if self.google_api_key:
-            # Use Google Gemini directly (flash model for better availability)
-            self.use_google = True
-            self.base_url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:generateContent?key={self.google_api_key}"
-            self.model_id = "gemini-2.5-flash"
-        elif self.openrouter_api_key:
-            # Fallback to OpenRouter
-            self.use_google = False
-            self.base_url = "https://openrouter.ai/api/v1/chat/completions"
-            self.model_id = "google/gemini-2.0-flash-exp:free"
-        else:
-            raise ValueError("Neither GOOGLE_API_KEY nor OPENROUTER_API_KEY environment variable is set")
-        
-    def _build_system_prompt(self) -> str:
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.started = False
+        self.complete = False
+
+    def feed(self, chunk: str) -> bool:
+        """Consume a chunk; returns True once a balanced object has been seen"""
+        if self.complete:
+            return True
+        for ch in chunk:
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == '\\':
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == '"':
+                if self.started:
+                    self.in_string = True
+            elif ch == '{':
+                self.depth += 1
+                self.started = True
+            elif ch == '}':
+                self.depth -= 1
+                if self.started and self.depth == 0:
+                    self.complete = True
+                    return True
+        return False
+
+
+class OpenRouterClient:
+    """Base class for LLM analysis clients: prompt building and response parsing"""
+
+    def __init__(self, client: httpx.AsyncClient):
+        # Shared long-lived HTTP client (owned by the app lifespan, not by us)
+        self.client = client
+
+        # The system prompt is a constant; build it once instead of per request
+        self._system_prompt = self._build_system_prompt()
+
+    async def analyze_transactions(self, request: AnalyzeRequest) -> Union[AnalysisResponse, Dict[str, Any]]:
+        """
+        Call the provider's API to analyze transactions
+        Returns either AnalysisResponse or ErrorResponse
+        """
+        raise NotImplementedError
+
+    @staticmethod
+    def _build_system_prompt() -> str:
         """Build the system prompt for the LLM"""
         return """You are FinoSpark AI, an expert financial and emotional intelligence analyst. 
 Your task is to analyze transaction data and provide insights in a specific JSON format.
@@ -67,240 +182,269 @@ Respond ONLY with valid JSON. No markdown, no explanations, just the JSON object
 
     def _build_user_prompt(self, request: AnalyzeRequest) -> str:
         """Build user prompt from transaction data"""
-        transactions_text = "\n".join([
-            f"- {t.date}: {t.currency} {t.amount:.2f} at {t.merchant or 'Unknown'} "
-            f"({t.category or 'Uncategorized'}){' - ' + t.note if t.note else ''}"
-            for t in request.transactions
-        ])
-        
-        total_amount = sum(t.amount for t in request.transactions)
-        avg_amount = total_amount / len(request.transactions) if request.transactions else 0
-        
+        # Single pass over the transactions: format each line and accumulate
+        # the total as we go instead of iterating the list multiple times.
+        # Attribute reads are hoisted into locals so each is done exactly once,
+        # and the lines are assembled with one "".join at the end.
+        transactions = request.transactions
+        parts = []
+        total_amount = 0.0
+        for t in transactions:
+            date = t.date
+            amount = t.amount
+            cur = t.currency
+            merchant = t.merchant or 'Unknown'
+            category = t.category or 'Uncategorized'
+            note = t.note
+
+            total_amount += amount
+            parts.append(f"- {date}: {cur} {amount:.2f} at {merchant} ({category})")
+            if note:
+                parts.append(f" - {note}")
+            parts.append("\n")
+
+        # Drop the trailing newline left by the last transaction
+        transactions_text = "".join(parts)[:-1]
+        currency = transactions[0].currency if transactions else 'INR'
+        avg_amount = total_amount / len(transactions) if transactions else 0
+
         user_prompt = f"""Analyze these financial transactions for user {request.user_id}:
 
-TRANSACTIONS ({len(request.transactions)} total):
+TRANSACTIONS ({len(transactions)} total):
 {transactions_text}
 
 SUMMARY:
-- Total spent: {request.transactions[0].currency if request.transactions else 'INR'} {total_amount:.2f}
-- Average transaction: {request.transactions[0].currency if request.transactions else 'INR'} {avg_amount:.2f}
+- Total spent: {currency} {total_amount:.2f}
+- Average transaction: {currency} {avg_amount:.2f}
 
 ADDITIONAL NOTES:
 {request.notes or 'None provided'}
 
 Provide your analysis in the required JSON format."""
-        
+
         return user_prompt
 
     def _extract_json_from_response(self, text: str) -> Optional[Dict[str, Any]]:
         """Try to extract JSON from response text, including markdown and truncated cases. Returns partial JSON if possible."""
         # Remove markdown code block markers if present
         if text.strip().startswith('```'):
-            text = re.sub(r'^```[a-zA-Z]*\s*', '', text.strip())
-            text = re.sub(r'```$', '', text.strip())
+            text = _MD_FENCE_START.sub('', text.strip())
+            text = _MD_FENCE_END.sub('', text.strip())
 
         # Try to parse directly first
         try:
-            return json.loads(text)
+            return orjson.loads(text)
         except Exception:
             pass
 
-        # Try to find JSON in markdown code blocks
-        json_match = re.search(r'```(?:json)?\s*(\{[\s\S]*?\})\s*```', text)
-        if json_match:
-            try:
-                return json.loads(json_match.group(1))
-            except Exception:
-                pass
-
-        # Try to find the largest JSON object in the text
-        json_match = re.search(r'(\{[\s\S]*\})', text)
-        if json_match:
-            json_str = json_match.group(1)
-            # Try to fix truncated JSON by removing trailing incomplete structures
-            # Find last closing curly brace
-            last_brace = json_str.rfind('}')
-            if last_brace != -1:
-                json_str = json_str[:last_brace+1]
-            # Remove trailing commas before closing braces (common truncation issue)
-            json_str = re.sub(r',\s*([}\]])', r'\1', json_str)
+        # Single linear scan for the first balanced object (covers JSON inside
+        # markdown blocks, surrounding prose, and truncated output)
+        json_str = _find_balanced_json(text)
+        if json_str is None:
+            return None
+
+        try:
+            return orjson.loads(json_str)
+        except Exception:
+            pass
+
+        # Last resort: drop a trailing comma left dangling by truncation
+        try:
+            return orjson.loads(_TRAILING_COMMA.sub(r'\1', json_str))
+        except Exception:
+            return None
+
+    def _parse_content(self, content: str) -> Union[AnalysisResponse, Dict[str, Any]]:
+        """Parse and validate LLM output into an AnalysisResponse"""
+        # Happy path: the model returned plain JSON, which Pydantic can parse
+        # and validate in one pass
+        try:
+            return _ANALYSIS_ADAPTER.validate_json(content)
+        except Exception:
+            pass
+
+        # Lenient path: markdown fences, surrounding prose, or truncation
+        json_data = self._extract_json_from_response(content)
+        if json_data:
             try:
-                return json.loads(json_str)
-            except Exception:
-                # Try to recover partial JSON by iteratively removing last key-value pairs
-                while True:
-                    # Remove last key-value pair
-                    json_str = re.sub(r',\s*"[^"]*"\s*:\s*[^,{}\[\]]*([}\]])', r'\1', json_str)
-                    try:
-                        return json.loads(json_str)
-                    except Exception:
-                        # If nothing left to parse, break
-                        if json_str.count(':') == 0:
-                            break
-                pass
-
-        # If still not valid, try to recover by adding missing closing braces
-        if 'json_str' in locals():
-            open_braces = json_str.count('{')
-            close_braces = json_str.count('}')
-            if open_braces > close_braces:
-                json_str += '}' * (open_braces - close_braces)
-                try:
-                    return json.loads(json_str)
-                except Exception:
-                    pass
+                # Return the model instance itself; the endpoint serializes
+                # it once instead of round-tripping a dict
+                return _ANALYSIS_ADAPTER.validate_python(json_data)
+            except Exception as validation_error:
+                return ErrorResponse(
+                    error="Validation failed",
+                    details=str(validation_error),
+                    raw_response=content
+                ).model_dump()
 
-        return None
+        return ErrorResponse(
+            error="Failed to extract JSON from model response",
+            details="The model did not return valid JSON",
+            raw_response=content
+        ).model_dump()
 
-    async def analyze_transactions(self, request: AnalyzeRequest) -> Dict[str, Any]:
-        """
-        Call OpenRouter API or Google Gemini API to analyze transactions
-        Returns either AnalysisResponse or ErrorResponse
-        """
-        system_prompt = self._build_system_prompt()
-        user_prompt = self._build_user_prompt(request)
-        
-        if self.use_google:
-            return await self._call_google_api(system_prompt, user_prompt)
-        else:
-            return await self._call_openrouter_api(system_prompt, user_prompt)
-    
-    async def _call_google_api(self, system_prompt: str, user_prompt: str) -> Dict[str, Any]:
-        """Call Google Gemini API directly"""
+
+class GoogleGeminiClient(OpenRouterClient):
+    """Client for the Google Gemini API (flash model for better availability)"""
+
+    def __init__(self, client: httpx.AsyncClient, api_key: str):
+        super().__init__(client)
+        self.model_id = "gemini-2.5-flash"
+        self.base_url = f"https://generativelanguage.googleapis.com/v1beta/models/{self.model_id}:streamGenerateContent?alt=sse&key={api_key}"
+
+    async def analyze_transactions(self, request: AnalyzeRequest) -> Union[AnalysisResponse, Dict[str, Any]]:
+        """Stream from Gemini, returning as soon as a complete JSON object arrives"""
         payload = {
             "contents": [{
                 "parts": [{
-                    "text": f"{system_prompt}\n\n{user_prompt}"
+                    "text": f"{self._system_prompt}\n\n{self._build_user_prompt(request)}"
                 }]
             }],
             "generationConfig": {
                 "temperature": 0.2,
-                "maxOutputTokens": 2048
+                "maxOutputTokens": 2048,
+                # Structured output: the model returns raw JSON matching our
+                # schema, so responses normally skip the lenient extractor
+                "responseMimeType": "application/json",
+                "responseSchema": _ANALYSIS_JSON_SCHEMA
             }
         }
-        
+
         try:
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                response = await client.post(
-                    self.base_url,
-                    json=payload
-                )
-                response.raise_for_status()
-                
-                response_data = response.json()
-                
-                # Extract content from Google's response format
-                if "candidates" in response_data and len(response_data["candidates"]) > 0:
-                    content = response_data["candidates"][0]["content"]["parts"][0]["text"]
-                    
-                    # Try to extract JSON from the response
-                    json_data = self._extract_json_from_response(content)
-                    
-                    if json_data:
-                        # Validate against our schema
-                        try:
-                            validated = AnalysisResponse(**json_data)
-                            return validated.dict()
-                        except Exception as validation_error:
-                            return ErrorResponse(
-                                error="Validation failed",
-                                details=str(validation_error),
-                                raw_response=content
-                            ).dict()
-                    else:
-                        return ErrorResponse(
-                            error="Failed to extract JSON from model response",
-                            details="The model did not return valid JSON",
-                            raw_response=content
-                        ).dict()
-                else:
-                    return ErrorResponse(
-                        error="Unexpected API response structure",
-                        details="No candidates in response",
-                        raw_response=str(response_data)
-                    ).dict()
-                    
+            async with self.client.stream(
+                "POST",
+                self.base_url,
+                json=payload
+            ) as response:
+                if response.status_code >= 400:
+                    # Read the body while the stream is still open so the
+                    # error handler below can include it
+                    await response.aread()
+                    response.raise_for_status()
+
+                # Server-sent events: each "data:" line carries a chunk with a
+                # text delta. Accumulate deltas and stop as soon as the JSON
+                # object is balanced rather than waiting for the stop token.
+                parts = []
+                tracker = _JsonStreamTracker()
+                async for line in response.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[5:].strip()
+                    if not data or data == "[DONE]":
+                        continue
+                    try:
+                        chunk = orjson.loads(data)
+                    except Exception:
+                        continue
+
+                    candidates = chunk.get("candidates")
+                    if not candidates:
+                        continue
+                    chunk_parts = candidates[0].get("content", {}).get("parts", [])
+                    text = chunk_parts[0].get("text", "") if chunk_parts else ""
+                    if not text:
+                        continue
+
+                    parts.append(text)
+                    if tracker.feed(text):
+                        break
+
+            if not parts:
+                return ErrorResponse(
+                    error="Unexpected API response structure",
+                    details="No candidates in response"
+                ).model_dump()
+
+            return self._parse_content("".join(parts))
+
         except httpx.HTTPStatusError as e:
             return ErrorResponse(
                 error=f"API request failed with status {e.response.status_code}",
                 details=str(e),
                 raw_response=e.response.text
-            ).dict()
+            ).model_dump()
         except Exception as e:
             return ErrorResponse(
                 error="Unexpected error during API call",
                 details=str(e)
-            ).dict()
-    
-    async def _call_openrouter_api(self, system_prompt: str, user_prompt: str) -> Dict[str, Any]:
-        """Call OpenRouter API"""
-        headers = {
-            "Authorization": f"Bearer {self.openrouter_api_key}",
+            ).model_dump()
+
+
+class OpenRouterAPIClient(OpenRouterClient):
+    """Client for the OpenRouter chat completions API"""
+
+    def __init__(self, client: httpx.AsyncClient, api_key: str):
+        super().__init__(client)
+        self.model_id = "google/gemini-2.0-flash-exp:free"
+        self.base_url = "https://openrouter.ai/api/v1/chat/completions"
+        self.headers = {
+            "Authorization": f"Bearer {api_key}",
             "Content-Type": "application/json",
             "HTTP-Referer": "https://finospark.app",
             "X-Title": "FinoSpark MVP"
         }
-        
+
+    async def analyze_transactions(self, request: AnalyzeRequest) -> Union[AnalysisResponse, Dict[str, Any]]:
+        """Call OpenRouter API"""
         payload = {
             "model": self.model_id,
             "messages": [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
+                {"role": "system", "content": self._system_prompt},
+                {"role": "user", "content": self._build_user_prompt(request)}
             ],
             "temperature": 0.2,
-            "max_tokens": 1500
+            "max_tokens": 1500,
+            # OpenAI-style JSON mode: no markdown fences around the output
+            "response_format": {"type": "json_object"}
         }
-        
+
         try:
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                response = await client.post(
-                    self.base_url,
-                    headers=headers,
-                    json=payload
-                )
-                response.raise_for_status()
-                
-                response_data = response.json()
-                
-                # Extract the assistant's message
-                if "choices" in response_data and len(response_data["choices"]) > 0:
-                    content = response_data["choices"][0]["message"]["content"]
-                    
-                    # Try to extract JSON from the response
-                    json_data = self._extract_json_from_response(content)
-                    
-                    if json_data:
-                        # Validate against our schema
-                        try:
-                            validated = AnalysisResponse(**json_data)
-                            return validated.dict()
-                        except Exception as validation_error:
-                            return ErrorResponse(
-                                error="Validation failed",
-                                details=str(validation_error),
-                                raw_response=content
-                            ).dict()
-                    else:
-                        return ErrorResponse(
-                            error="Failed to extract JSON from model response",
-                            details="The model did not return valid JSON",
-                            raw_response=content
-                        ).dict()
-                else:
-                    return ErrorResponse(
-                        error="Unexpected API response structure",
-                        details="No choices in response",
-                        raw_response=str(response_data)
-                    ).dict()
-                    
+            response = await self.client.post(
+                self.base_url,
+                headers=self.headers,
+                json=payload
+            )
+            response.raise_for_status()
+
+            response_data = response.json()
+
+            # Extract the assistant's message
+            if "choices" in response_data and len(response_data["choices"]) > 0:
+                content = response_data["choices"][0]["message"]["content"]
+
+                return self._parse_content(content)
+            else:
+                return ErrorResponse(
+                    error="Unexpected API response structure",
+                    details="No choices in response",
+                    raw_response=str(response_data)
+                ).model_dump()
+
         except httpx.HTTPStatusError as e:
             return ErrorResponse(
                 error=f"API request failed with status {e.response.status_code}",
                 details=str(e),
                 raw_response=e.response.text
-            ).dict()
+            ).model_dump()
         except Exception as e:
             return ErrorResponse(
                 error="Unexpected error during API call",
                 details=str(e)
-            ).dict()
+            ).model_dump()
+
+
+def build_client(client: httpx.AsyncClient) -> OpenRouterClient:
+    """
+    Pick the provider once at startup based on configured API keys
+    Prefers Google Gemini (more reliable), falling back to OpenRouter
+    """
+    google_api_key = os.getenv("GOOGLE_API_KEY")
+    if google_api_key:
+        return GoogleGeminiClient(client, google_api_key)
+
+    openrouter_api_key = os.getenv("OPENROUTER_API_KEY")
+    if openrouter_api_key:
+        return OpenRouterAPIClient(client, openrouter_api_key)
+
+    raise ValueError("Neither GOOGLE_API_KEY nor OPENROUTER_API_KEY environment variable is set")
@@ -1,12 +1,17 @@
 """
 Pydantic models for request/response validation
 """
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 from typing import List, Optional
 
 
 class Transaction(BaseModel):
     """Single transaction entry"""
+    # Transactions are never mutated after parsing; frozen instances are safe
+    # to share (e.g. between cached analyses), and unknown fields from client
+    # payloads are dropped instead of being stored
+    model_config = ConfigDict(frozen=True, extra='ignore')
+
     date: str = Field(..., description="Transaction date in YYYY-MM-DD format")
     amount: float = Field(..., description="Transaction amount")
     currency: str = Field(default="INR", description="Currency code")
@@ -17,13 +22,19 @@ class Transaction(BaseModel):
 
 class AnalyzeRequest(BaseModel):
     """Request body for /analyze endpoint"""
+    model_config = ConfigDict(extra='ignore')
+
     user_id: str = Field(..., description="Unique user identifier")
-    transactions: List[Transaction] = Field(..., description="List of transactions to analyze")
+    # Bounds enforced in the validator core: an empty or absurdly large list
+    # is rejected with a 422 before any Transaction objects are built
+    transactions: List[Transaction] = Field(..., min_length=1, max_length=1000, description="List of transactions to analyze")
     notes: Optional[str] = Field(default="", description="Optional additional context or notes")
 
 
 class Recommendation(BaseModel):
     """Single recommendation item"""
+    model_config = ConfigDict(extra='ignore')
+
     title: str
     desc: str
     priority: int
@@ -31,6 +42,8 @@ class Recommendation(BaseModel):
 
 class SavingsPlan(BaseModel):
     """30-day savings micro-plan"""
+    model_config = ConfigDict(extra='ignore')
+
     target_amount: float
     period_days: int = 30
     steps: List[str]
@@ -38,6 +51,9 @@ class SavingsPlan(BaseModel):
 
 class AnalysisResponse(BaseModel):
     """Response from the analysis endpoint"""
+    # LLM output can be chatty; ignore any extra keys it invents
+    model_config = ConfigDict(extra='ignore')
+
     emotion: str = Field(..., description="Detected emotional tone: calm, stressed, anxious, excited, neutral")
     financial_profile: str = Field(..., description="Financial profile: spender, saver, balanced, investor")
     confidence: float = Field(..., description="Confidence score 0.0-1.0")
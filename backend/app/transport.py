@@ -0,0 +1,84 @@
+"""
+aiohttp-backed transport for httpx
+httpx's built-in async transport is a known bottleneck under high concurrency;
+routing requests through an aiohttp ClientSession keeps the httpx API (and the
+Pydantic validation path) unchanged while getting aiohttp's connection handling.
+"""
+from typing import Optional
+import httpx
+
+try:
+    import aiohttp
+except ImportError:
+    # aiohttp is optional; callers fall back to httpx's default transport
+    aiohttp = None
+
+
+class AiohttpResponseStream(httpx.AsyncByteStream):
+    """Exposes an aiohttp response body as an httpx byte stream"""
+
+    CHUNK_SIZE = 1024 * 16
+
+    def __init__(self, response: "aiohttp.ClientResponse"):
+        self._response = response
+
+    async def __aiter__(self):
+        async for chunk in self._response.content.iter_chunked(self.CHUNK_SIZE):
+            yield chunk
+
+    async def aclose(self):
+        self._response.release()
+
+
+class AiohttpTransport(httpx.AsyncBaseTransport):
+    """httpx transport that sends requests through an aiohttp ClientSession"""
+
+    def __init__(self, session: "aiohttp.ClientSession"):
+        self.session = session
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        # httpx hands the configured timeouts to the transport via the request
+        # extensions; it's this transport's job to enforce them
+        timeouts = request.extensions.get("timeout", {})
+        response = await self.session.request(
+            method=request.method,
+            url=str(request.url),
+            headers=dict(request.headers),
+            data=request.content,
+            allow_redirects=False,
+            timeout=aiohttp.ClientTimeout(
+                sock_connect=timeouts.get("connect"),
+                sock_read=timeouts.get("read"),
+            ),
+        )
+        return httpx.Response(
+            status_code=response.status,
+            headers=list(response.headers.items()),
+            stream=AiohttpResponseStream(response),
+            request=request,
+        )
+
+    async def aclose(self):
+        await self.session.close()
+
+
+def build_aiohttp_transport() -> Optional[AiohttpTransport]:
+    """
+    Build an aiohttp-backed transport with a pooled connector,
+    or return None if aiohttp is not installed
+    """
+    if aiohttp is None:
+        return None
+
+    session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(
+            limit=200,
+            ttl_dns_cache=300,
+            keepalive_timeout=75,
+        ),
+        # Leave bodies compressed: httpx decodes them based on the response's
+        # Content-Encoding header. If aiohttp decompressed too, httpx would
+        # try to gunzip plain JSON and fail.
+        auto_decompress=False,
+    )
+    return AiohttpTransport(session)